@@ -3,8 +3,11 @@ SPDX-FileCopyrightText: 2025 Roger Ortiz <me@r0rt1z2.com>
 SPDX-License-Identifier: GPL-3.0-or-later
 """
 
+from __future__ import annotations
+
+import importlib
 from pathlib import Path
-from typing import Final
+from typing import TYPE_CHECKING, Any, Dict, Final
 
 from md1imgpy.config import Md1ImgConfig
 from md1imgpy.exceptions import (
@@ -14,9 +17,19 @@ from md1imgpy.exceptions import (
     MapFileNotFoundError,
     Md1ImgError,
 )
-from md1imgpy.image import Md1Image
-from md1imgpy.packer import Md1Packer
-from md1imgpy.unpacker import Md1Unpacker
+
+if TYPE_CHECKING:
+    from md1imgpy.image import Md1Image
+    from md1imgpy.packer import Md1Packer
+    from md1imgpy.unpacker import Md1Unpacker
+
+# Heavier classes are only imported on first access, so that importing
+# the package (or just its config/exceptions) stays cheap.
+_LAZY_IMPORTS: Final[Dict[str, str]] = {
+    'Md1Image': 'md1imgpy.image',
+    'Md1Packer': 'md1imgpy.packer',
+    'Md1Unpacker': 'md1imgpy.unpacker',
+}
 
 __version__: Final[str] = '0.1.0'
 __author__: Final[str] = 'Roger Ortiz <me@r0rt1z2.com>'
@@ -44,3 +57,23 @@ __all__ = [
     '__author__',
     '__description__',
 ]
+
+
+def __getattr__(name: str) -> Any:
+    """
+    Import lazily exported classes on first access.
+
+    Args:
+        name: Name of the requested attribute
+
+    Returns:
+        The requested attribute
+
+    Raises:
+        AttributeError: If the attribute doesn't exist
+    """
+    if name in _LAZY_IMPORTS:
+        value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
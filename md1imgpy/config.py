@@ -10,7 +10,14 @@ import logging
 from dataclasses import dataclass
 from enum import Enum, auto
 from pathlib import Path
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Final, Optional, Union
+
+try:
+    import orjson
+
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 from md1imgpy.exceptions import ConfigurationError
 
@@ -54,13 +61,7 @@ class LogLevel(Enum):
         Returns:
             Corresponding logging module level as integer
         """
-        return {
-            LogLevel.DEBUG: logging.DEBUG,
-            LogLevel.INFO: logging.INFO,
-            LogLevel.WARNING: logging.WARNING,
-            LogLevel.ERROR: logging.ERROR,
-            LogLevel.CRITICAL: logging.CRITICAL,
-        }[self]
+        return _LOGLEVEL_TO_LOGGING[self]
 
 
 class CompressionFormat(Enum):
@@ -85,19 +86,35 @@ class CompressionFormat(Enum):
             ValueError: If string doesn't match any format
         """
         value = value.upper()
-        if value in ('GZ', 'GZIP'):
-            return cls.GZIP
-        elif value in ('XZ', 'LZMA'):
-            return cls.XZ
-        elif value in ('NONE', 'RAW'):
-            return cls.NONE
-        else:
+        try:
+            return _STR_TO_COMPRESSION[value]
+        except KeyError:
             valid_formats = ['NONE', 'GZIP', 'XZ']
             raise ValueError(
                 f'Invalid compression format: {value}. Valid formats: {", ".join(valid_formats)}'
             )
 
 
+_LOGLEVEL_TO_LOGGING: Final[Dict[LogLevel, int]] = {
+    LogLevel.DEBUG: logging.DEBUG,
+    LogLevel.INFO: logging.INFO,
+    LogLevel.WARNING: logging.WARNING,
+    LogLevel.ERROR: logging.ERROR,
+    LogLevel.CRITICAL: logging.CRITICAL,
+}
+
+_STR_TO_COMPRESSION: Final[Dict[str, CompressionFormat]] = {
+    'GZ': CompressionFormat.GZIP,
+    'GZIP': CompressionFormat.GZIP,
+    'XZ': CompressionFormat.XZ,
+    'LZMA': CompressionFormat.XZ,
+    'NONE': CompressionFormat.NONE,
+    'RAW': CompressionFormat.NONE,
+}
+
+_BOOL_FIELDS: Final = ('backup', 'dry_run', 'verbose', 'fast_gzip')
+
+
 @dataclass
 class Md1ImgConfig:
     """
@@ -110,6 +127,8 @@ class Md1ImgConfig:
         compression_format: Default compression format for files
         dry_run: Whether to perform a dry run without writing changes
         verbose: Whether to print detailed information
+        fast_gzip: Whether to gzip with ISA-L (if installed), trading
+            compression ratio for speed
     """
 
     log_level: LogLevel = LogLevel.INFO
@@ -118,6 +137,7 @@ class Md1ImgConfig:
     compression_format: CompressionFormat = CompressionFormat.NONE
     dry_run: bool = False
     verbose: bool = False
+    fast_gzip: bool = False
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> Md1ImgConfig:
@@ -136,22 +156,25 @@ class Md1ImgConfig:
         config = cls()
 
         try:
-            if 'log_level' in data:
-                config.log_level = LogLevel.from_string(data['log_level'])
-
-            for bool_field in ['backup', 'dry_run', 'verbose']:
-                if bool_field in data:
-                    setattr(config, bool_field, bool(data[bool_field]))
-
-            if 'backup_dir' in data:
-                backup_dir = Path(data['backup_dir'])
-                if not backup_dir.exists():
-                    backup_dir.mkdir(parents=True, exist_ok=True)
+            log_level = data.get('log_level')
+            if log_level is not None:
+                config.log_level = LogLevel.from_string(log_level)
+
+            for bool_field in _BOOL_FIELDS:
+                value = data.get(bool_field)
+                if value is not None:
+                    setattr(config, bool_field, bool(value))
+
+            backup_dir_value = data.get('backup_dir')
+            if backup_dir_value is not None:
+                backup_dir = Path(backup_dir_value)
+                backup_dir.mkdir(parents=True, exist_ok=True)
                 config.backup_dir = backup_dir
 
-            if 'compression_format' in data:
+            compression_format = data.get('compression_format')
+            if compression_format is not None:
                 config.compression_format = CompressionFormat.from_string(
-                    data['compression_format']
+                    compression_format
                 )
 
         except (ValueError, TypeError, OSError) as e:
@@ -174,11 +197,16 @@ class Md1ImgConfig:
             ConfigurationError: If file cannot be read or parsed
         """
         try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
+            raw = Path(file_path).read_bytes()
+
+            if ORJSON_AVAILABLE:
+                data = orjson.loads(raw)
+            else:
+                data = json.loads(raw)
             return cls.from_dict(data)
         except FileNotFoundError:
             raise ConfigurationError('Configuration file not found', file_path)
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError.
         except json.JSONDecodeError as e:
             raise ConfigurationError(f'Invalid JSON: {e}', file_path)
         except Exception as e:
@@ -198,6 +226,7 @@ class Md1ImgConfig:
             'compression_format': self.compression_format.name,
             'dry_run': self.dry_run,
             'verbose': self.verbose,
+            'fast_gzip': self.fast_gzip,
         }
 
     def save(self, file_path: Union[str, Path]) -> None:
@@ -210,9 +239,13 @@ class Md1ImgConfig:
         Raises:
             ConfigurationError: If file cannot be written
         """
+        if ORJSON_AVAILABLE:
+            content = orjson.dumps(self.to_dict(), option=orjson.OPT_INDENT_2)
+        else:
+            content = json.dumps(self.to_dict(), indent=2).encode('utf-8')
+
         try:
-            with open(file_path, 'w') as f:
-                json.dump(self.to_dict(), f, indent=4)
+            Path(file_path).write_bytes(content)
         except (OSError, IOError) as e:
             raise ConfigurationError(
                 f'Failed to save configuration: {e}', file_path
@@ -7,19 +7,41 @@ from __future__ import annotations
 
 import ctypes
 import logging
+import mmap
 import os
+import sys
 from dataclasses import dataclass
 from pathlib import Path
-from typing import BinaryIO, Dict, List, Optional, Union
+from typing import Dict, Final, List, Optional, Union
 
 from md1imgpy.exceptions import HeaderError, InvalidIOFile
 from md1imgpy.structures import (
     FILE_MAP_MARKER,
     Md1Header,
 )
+from md1imgpy.utils import preallocate_file
 
 logger = logging.getLogger(__name__)
 
+_HDR_SIZE: Final[int] = ctypes.sizeof(Md1Header)
+
+# The file map is normally the last entry of an image, so the marker is
+# first looked for in this many trailing bytes before scanning it all.
+_MAP_SEARCH_WINDOW: Final[int] = 64 * 1024
+
+
+def _align16(value: int) -> int:
+    """
+    Round a size or offset up to the next 16-byte boundary.
+
+    Args:
+        value: Value to align
+
+    Returns:
+        Aligned value
+    """
+    return (value + 15) & ~15
+
 
 @dataclass
 class Md1File:
@@ -29,13 +51,17 @@ class Md1File:
     Attributes:
         name: Original name of the file
         header: MD1 header for this file
-        data: Raw data of the file
+        data: Raw data of the file (a read-only view into the image
+            file for images loaded from disk)
         offset: Offset of the file in the image
     """
 
+    # Spelled out by hand since dataclass(slots=True) needs Python 3.10.
+    __slots__ = ('data', 'header', 'name', 'offset')
+
     name: str
     header: Md1Header
-    data: bytes
+    data: Union[bytes, memoryview]
     offset: int
 
     @property
@@ -58,13 +84,27 @@ class Md1File:
         return f'MD1File: {self.name} (size: {self.size} bytes, offset: 0x{self.offset:08x})\n{str(self.header)}'
 
 
+def _block_size(md1_file: Md1File) -> int:
+    """
+    Get the space a file takes in the image, header and padding included.
+
+    Args:
+        md1_file: File to measure
+
+    Returns:
+        Size in bytes, rounded up to a 16-byte boundary
+    """
+    return _align16(md1_file.header.data_offset + md1_file.size)
+
+
 class Md1Image:
     """
     Represents an MD1 image with methods to read and modify its contents.
 
     Attributes:
         path: Path to the image file
-        files: List of files in the image
+        files: List of files in the image (modify it through add_file
+            and remove_file to keep lookups by name in sync)
         file_mapping: Mapping from original filenames to external ones
         meta_info: Metadata for each file in the image
     """
@@ -83,6 +123,9 @@ class Md1Image:
         self.files: List[Md1File] = []
         self.file_mapping: Dict[str, str] = {}
         self.meta_info: Dict[str, Dict[str, str]] = {}
+        self._by_name: Dict[str, Md1File] = {}
+        self._size = 0
+        self._mm: Optional[mmap.mmap] = None
 
         if self.path and self.path.exists():
             self._load_image()
@@ -100,110 +143,97 @@ class Md1Image:
 
         try:
             with open(self.path, 'rb') as f:
-                self._find_file_mapping(f)
-
-                f.seek(0)
-                file_size = os.path.getsize(self.path)
-                offset = 0
-
-                while offset < file_size:
-                    f.seek(offset)
-
-                    header_data = f.read(ctypes.sizeof(Md1Header))
-                    if not header_data or len(header_data) < ctypes.sizeof(
-                        Md1Header
-                    ):
-                        break
-
-                    try:
-                        header = Md1Header.from_bytes(header_data)
-                    except HeaderError:
-                        break
-
-                    name = header.name.decode('utf-8', errors='ignore').rstrip(
-                        '\x00'
-                    )
-                    logger.debug(
-                        f'Found file: {name} (size: {header.data_size} bytes, offset: 0x{offset:08x})'
-                    )
-
-                    f.seek(offset + header.data_offset)
-
-                    data = f.read(header.data_size)
-                    if len(data) != header.data_size:
-                        logger.warning(
-                            f'Truncated data for {name}: expected {header.data_size}, got {len(data)} bytes'
-                        )
-
-                    md1_file = Md1File(
-                        name=name, header=header, data=data, offset=offset
-                    )
-                    self.files.append(md1_file)
-
-                    offset += header.data_offset + header.data_size
-                    if offset % 16 != 0:
-                        offset += 16 - (offset % 16)
-
+                if not os.fstat(f.fileno()).st_size:
+                    return
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         except (OSError, IOError) as e:
             raise InvalidIOFile(f'Failed to load MD1 image: {e}', self.path)
 
-    def _find_file_mapping(self, f: BinaryIO) -> None:
+        # Payloads are exposed as views into the mapping, so it has to
+        # stay open for as long as the image (or any of its files) lives.
+        self._mm = mm
+        view = memoryview(mm)
+
+        self._find_file_mapping(mm)
+
+        file_size = len(mm)
+        offset = 0
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        while offset + _HDR_SIZE <= file_size:
+            try:
+                header = Md1Header.unpack_from(view, offset)
+            except HeaderError:
+                break
+
+            name = sys.intern(
+                header.name.decode('utf-8', errors='ignore').rstrip('\x00')
+            )
+            if debug:
+                logger.debug(
+                    f'Found file: {name} (size: {header.data_size} bytes, offset: 0x{offset:08x})'
+                )
+
+            data_start = offset + header.data_offset
+            data = view[data_start : data_start + header.data_size]
+            if len(data) != header.data_size:
+                logger.warning(
+                    f'Truncated data for {name}: expected {header.data_size}, got {len(data)} bytes'
+                )
+
+            md1_file = Md1File(
+                name=name, header=header, data=data, offset=offset
+            )
+            self.files.append(md1_file)
+            self._by_name.setdefault(name, md1_file)
+            self._size += _align16(header.data_offset + len(data))
+
+            offset = _align16(offset + header.data_offset + header.data_size)
+
+    def _find_file_mapping(self, mm: mmap.mmap) -> None:
         """
         Find and parse the file mapping within the image.
 
         Args:
-            f: Open file handle for the image
-
-        Raises:
-            MapFileNotFoundError: If mapping is not found and required
+            mm: Memory-mapped contents of the image
         """
-        try:
-            f.seek(0, os.SEEK_END)
-            file_size = f.tell()
-
-            buffer_size = 16384
-            marker = FILE_MAP_MARKER
-
-            pos = file_size
-            while pos > 0:
-                chunk_size = min(buffer_size, pos)
-                pos -= chunk_size
-                f.seek(pos)
-                buffer = f.read(chunk_size)
-
-                marker_pos = buffer.rfind(marker)
-                if marker_pos >= 0:
-                    map_offset = pos + marker_pos
-                    f.seek(map_offset + len(marker) + 504)
-                    map_content = f.read().decode('utf-8', errors='ignore')
-                    self._parse_file_mapping(map_content)
-                    return
-
+        map_offset = mm.rfind(
+            FILE_MAP_MARKER, max(0, len(mm) - _MAP_SEARCH_WINDOW)
+        )
+        if map_offset < 0:
+            map_offset = mm.rfind(FILE_MAP_MARKER)
+        if map_offset < 0:
             logger.warning('No file mapping found in image')
+            return
 
-        except (OSError, IOError) as e:
-            logger.error(f'Error searching for file mapping: {e}')
+        # The mapping is plain text, so it ends at the first NUL (usually
+        # the alignment padding) rather than at the end of the image.
+        map_start = map_offset + len(FILE_MAP_MARKER) + 504
+        map_end = mm.find(b'\x00', map_start)
+        if map_end < 0:
+            map_end = len(mm)
 
-    def _parse_file_mapping(self, content: str) -> None:
+        self._parse_file_mapping(mm[map_start:map_end])
+
+    def _parse_file_mapping(self, content: bytes) -> None:
         """
         Parse file mapping content.
 
         Args:
-            content: Text content of the mapping section
+            content: Raw content of the mapping section
         """
         self.file_mapping = {}
 
         for line in content.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-
-            parts = line.split('=', 1)
-            if len(parts) != 2:
+            key, separator, value = line.strip().partition(b'=')
+            if not separator:
                 continue
 
-            key, value = parts
-            self.file_mapping[key] = value
+            # Names repeat across the map, the headers and other images, so
+            # share one copy of each (and get identity-fast comparisons).
+            original = sys.intern(key.decode('utf-8', errors='ignore'))
+            mapped = sys.intern(value.decode('utf-8', errors='ignore'))
+            self.file_mapping[original] = mapped
 
     def save(self, output_path: Union[str, Path]) -> None:
         """
@@ -215,22 +245,129 @@ class Md1Image:
         Raises:
             InvalidIOFile: If the file cannot be written
         """
-        try:
-            with open(output_path, 'wb') as f:
-                for md1_file in self.files:
-                    f.write(md1_file.header.to_bytes())
-
-                    f.write(md1_file.data)
+        total_size = 0
+        for md1_file in self.files:
+            total_size += _HDR_SIZE + _align16(len(md1_file.data))
 
-                    padding_size = 16 - (len(md1_file.data) % 16)
-                    if padding_size != 16:
-                        f.write(b'\x00' * padding_size)
+        try:
+            if total_size and not self._is_source(output_path):
+                # Write straight into a mapping of the (preallocated)
+                # output file, so the image is never assembled in memory.
+                with open(output_path, 'w+b') as f:
+                    preallocate_file(f.fileno(), total_size)
+                    with mmap.mmap(f.fileno(), total_size) as mm:
+                        self._write_into(mm)
+            else:
+                # Payloads may be views into the very file being replaced,
+                # so everything is copied out before it gets truncated.
+                buffer = bytearray(total_size)
+                self._write_into(buffer)
+                if self._is_source(output_path):
+                    self._detach_from_mapping(buffer)
+                with open(output_path, 'wb') as f:
+                    f.write(buffer)
 
             logger.info(f'Saved MD1 image to {output_path}')
 
         except (OSError, IOError) as e:
             raise InvalidIOFile(f'Failed to save MD1 image: {e}', output_path)
 
+    def _write_into(self, buffer: Union[bytearray, mmap.mmap]) -> None:
+        """
+        Lay out every file (header, data and padding) into a buffer.
+
+        Args:
+            buffer: Zero-filled buffer large enough to hold the image
+        """
+        offset = 0
+
+        for md1_file in self.files:
+            data = md1_file.data
+            md1_file.header.pack_into(buffer, offset)
+            offset += _HDR_SIZE
+            buffer[offset : offset + len(data)] = data
+            offset += _align16(len(data))
+
+    def _detach_from_mapping(self, buffer: bytearray) -> None:
+        """
+        Point every payload at its copy in a laid out buffer and unmap the
+        image file, so that it can be replaced (Windows refuses to
+        truncate a file that is still mapped).
+
+        Args:
+            buffer: Buffer the image was laid out into by _write_into
+        """
+        view = memoryview(buffer)
+        offset = 0
+
+        for md1_file in self.files:
+            old_data = md1_file.data
+            size = len(old_data)
+            offset += _HDR_SIZE
+            md1_file.data = view[offset : offset + size]
+            offset += _align16(size)
+
+            if isinstance(old_data, memoryview):
+                old_data.release()
+
+        self.close()
+
+    def close(self) -> None:
+        """
+        Unmap the image file this image was loaded from.
+
+        Payloads that are still views into the file can't be used after
+        this; images that weren't loaded from a file are left as they are.
+        """
+        if self._mm is None:
+            return
+
+        for md1_file in self.files:
+            if (
+                isinstance(md1_file.data, memoryview)
+                and md1_file.data.obj is self._mm
+            ):
+                md1_file.data.release()
+
+        self._mm.close()
+        self._mm = None
+
+    def __enter__(self) -> Md1Image:
+        """
+        Use the image as a context manager that closes it on exit.
+
+        Returns:
+            The image itself
+        """
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """
+        Close the image when leaving the context.
+
+        Args:
+            exc_info: Exception details, if any (ignored)
+        """
+        self.close()
+
+    def _is_source(self, path: Union[str, Path]) -> bool:
+        """
+        Check whether a path refers to the file this image was loaded from.
+
+        Args:
+            path: Path to check
+
+        Returns:
+            True if the image is mapped from that file, False otherwise
+        """
+        if self._mm is None or self.path is None:
+            return False
+
+        try:
+            return os.path.samefile(path, self.path)
+        except OSError:
+            return False
+
     def get_file_by_name(self, name: str) -> Optional[Md1File]:
         """
         Get a file from the image by its name.
@@ -241,10 +378,7 @@ class Md1Image:
         Returns:
             Md1File object if found, None otherwise
         """
-        for md1_file in self.files:
-            if md1_file.name == name:
-                return md1_file
-        return None
+        return self._by_name.get(name)
 
     def get_file_names(self) -> List[str]:
         """
@@ -255,7 +389,13 @@ class Md1Image:
         """
         return [md1_file.name for md1_file in self.files]
 
-    def add_file(self, name: str, data: bytes, base: int = 0) -> Md1File:
+    def add_file(
+        self,
+        name: str,
+        data: Union[bytes, memoryview],
+        base: int = 0,
+        header: Optional[Md1Header] = None,
+    ) -> Md1File:
         """
         Add a new file to the image.
 
@@ -263,23 +403,23 @@ class Md1Image:
             name: Name of the file
             data: File data
             base: Base address for the file
+            header: Optional prebuilt header (base is ignored if given)
 
         Returns:
             The created Md1File object
         """
-        header = Md1Header.create(name, len(data), base)
+        if header is None:
+            header = Md1Header.create(name, len(data), base)
 
         offset = 0
         if self.files:
             last_file = self.files[-1]
-            offset = (
-                last_file.offset + last_file.header.data_offset + last_file.size
-            )
-            if offset % 16 != 0:
-                offset += 16 - (offset % 16)
+            offset = last_file.offset + _block_size(last_file)
 
         md1_file = Md1File(name=name, header=header, data=data, offset=offset)
         self.files.append(md1_file)
+        self._by_name.setdefault(name, md1_file)
+        self._size += _block_size(md1_file)
 
         return md1_file
 
@@ -293,11 +433,22 @@ class Md1Image:
         Returns:
             True if file was removed, False if not found
         """
-        for i, md1_file in enumerate(self.files):
-            if md1_file.name == name:
+        md1_file = self._by_name.pop(name, None)
+        if md1_file is None:
+            return False
+
+        for i, entry in enumerate(self.files):
+            if entry is md1_file:
                 self.files.pop(i)
-                return True
-        return False
+                break
+        self._size -= _block_size(md1_file)
+
+        for entry in self.files:
+            if entry.name == name:
+                self._by_name[name] = entry
+                break
+
+        return True
 
     @property
     def size(self) -> int:
@@ -307,13 +458,7 @@ class Md1Image:
         Returns:
             Size in bytes (estimated based on file contents)
         """
-        total_size = 0
-        for md1_file in self.files:
-            file_size = md1_file.header.data_offset + md1_file.size
-            if file_size % 16 != 0:
-                file_size += 16 - (file_size % 16)
-            total_size += file_size
-        return total_size
+        return self._size
 
     def __str__(self) -> str:
         """
@@ -327,13 +472,12 @@ class Md1Image:
         ]
         result.append(f'Files: {len(self.files)}')
 
-        for i, md1_file in enumerate(self.files, 1):
-            mapped_name = 'Unknown'
-            for original, mapped in self.file_mapping.items():
-                if mapped == md1_file.name:
-                    mapped_name = original
-                    break
+        original_names: Dict[str, str] = {}
+        for original, mapped in self.file_mapping.items():
+            original_names.setdefault(mapped, original)
 
+        for i, md1_file in enumerate(self.files, 1):
+            mapped_name = original_names.get(md1_file.name, 'Unknown')
             result.append(
                 f'{i}. {md1_file.name} -> {mapped_name} (size: {md1_file.size} bytes)'
             )
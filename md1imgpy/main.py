@@ -21,10 +21,6 @@ from md1imgpy.exceptions import (
     ConfigurationError,
     Md1ImgError,
 )
-from md1imgpy.image import Md1Image
-from md1imgpy.packer import Md1Packer
-from md1imgpy.unpacker import Md1Unpacker
-from md1imgpy.utils import create_backup
 
 
 def setup_logging(log_level: LogLevel, log_file: Optional[Path] = None) -> None:
@@ -62,6 +58,9 @@ def list_files(image_path: Path) -> int:
     Returns:
         Exit code (0 for success, non-zero for error)
     """
+    from md1imgpy.image import Md1Image
+    from md1imgpy.unpacker import Md1Unpacker
+
     try:
         image = Md1Image(image_path)
         unpacker = Md1Unpacker(image)
@@ -71,20 +70,24 @@ def list_files(image_path: Path) -> int:
             print('No files found in image.')
             return 0
 
-        print(f'\nFiles in MD1 image: {image_path}')
-        print('-' * 60)
-        print(
-            f'{"#":<4} {"Name":<20} {"Mapped Name":<20} {"Size":<10} {"Base":<10} {"Compression":<10}'
-        )
-        print('-' * 60)
+        separator = '-' * 60
+        lines = [
+            f'\nFiles in MD1 image: {image_path}',
+            separator,
+            f'{"#":<4} {"Name":<20} {"Mapped Name":<20} {"Size":<10} {"Base":<10} {"Compression":<10}',
+            separator,
+        ]
 
         for info in files:
-            print(
+            lines.append(
                 f'{info["index"]:<4} {info["name"]:<20} {info["mapped_name"]:<20} {info["size"]:<10} {info["base"]:<10} {info["compression"]:<10}'
             )
 
-        print('-' * 60)
-        print(f'Total: {len(files)} files')
+        lines.append(separator)
+        lines.append(f'Total: {len(files)} files')
+
+        # One write for the whole table instead of a print() per row.
+        sys.stdout.write('\n'.join(lines) + '\n')
 
         return 0
     except Md1ImgError as e:
@@ -165,6 +168,11 @@ def main() -> int:
         default='none',
         help='Default compression format for files without mapping',
     )
+    pack_parser.add_argument(
+        '--fast-gzip',
+        action='store_true',
+        help='Gzip with ISA-L if installed (faster, but larger output)',
+    )
 
     list_parser = subparsers.add_parser(
         'list', help='List files in an MD1 image'
@@ -229,38 +237,44 @@ def main() -> int:
         parser.print_help()
         return 0
 
+    # Every subcommand registers the common options, so from here on they
+    # are always present on args; only --compression and --fast-gzip are
+    # pack-specific.
     config = Md1ImgConfig()
-    if hasattr(args, 'config') and args.config:
+    if args.config:
         try:
             config = Md1ImgConfig.from_file(args.config)
         except ConfigurationError as e:
             print(f'Configuration error: {e}', file=sys.stderr)
             return 1
 
-    if hasattr(args, 'log_level'):
-        config.log_level = LogLevel.from_string(args.log_level)
-    if hasattr(args, 'backup'):
-        config.backup = args.backup
-    if hasattr(args, 'backup_dir'):
-        config.backup_dir = args.backup_dir
-    if hasattr(args, 'dry_run'):
-        config.dry_run = args.dry_run
-    if hasattr(args, 'verbose'):
-        config.verbose = args.verbose
-    if hasattr(args, 'compression'):
-        config.compression_format = CompressionFormat.from_string(
-            args.compression
-        )
+    config.log_level = LogLevel.from_string(args.log_level)
+    config.backup = args.backup
+    config.backup_dir = args.backup_dir
+    config.dry_run = args.dry_run
+    config.verbose = args.verbose
 
-    setup_logging(
-        config.log_level, args.log_file if hasattr(args, 'log_file') else None
-    )
+    compression = getattr(args, 'compression', None)
+    if compression is not None:
+        config.compression_format = CompressionFormat.from_string(compression)
+
+    if getattr(args, 'fast_gzip', False):
+        config.fast_gzip = True
+
+    setup_logging(config.log_level, args.log_file)
     logger = logging.getLogger(__name__)
 
     logger.info(f'MD1 Image Tool - version {__version__}')
 
+    # The packer and unpacker pull in the compression modules, so they
+    # are only imported once a command needs them. This keeps --help,
+    # --version and --export-config fast.
+
     try:
         if args.command == 'unpack':
+            from md1imgpy.unpacker import Md1Unpacker
+            from md1imgpy.utils import create_backup
+
             if not args.output:
                 output_dir = args.image.parent / args.image.stem
             else:
@@ -284,6 +298,8 @@ def main() -> int:
             )
 
         elif args.command == 'pack':
+            from md1imgpy.packer import Md1Packer
+
             if not args.output:
                 output_file = (
                     args.directory.parent / f'{args.directory.stem}-new.img'
@@ -5,26 +5,103 @@ SPDX-License-Identifier: GPL-3.0-or-later
 
 from __future__ import annotations
 
+import ctypes
+import functools
 import logging
+import mmap
+import os
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, Final, List, Optional, Tuple, Union
 
 from md1imgpy.config import CompressionFormat, Md1ImgConfig
 from md1imgpy.exceptions import InvalidIOFile, Md1ImgError
-from md1imgpy.image import Md1File, Md1Image
-from md1imgpy.structures import Md1Header
+from md1imgpy.image import Md1Image
+from md1imgpy.structures import FILE_MAP_MARKER, Md1Header
 from md1imgpy.utils import (
-    compress_gz,
-    compress_xz,
+    compress_gz_file,
+    compress_xz_file,
     extract_number,
     parse_meta_info,
     read_file_mapping,
     strip_number,
-    to_lowercase,
 )
 
 logger = logging.getLogger(__name__)
 
+_HDR_SIZE: Final[int] = ctypes.sizeof(Md1Header)
+
+# Header fields that can be overridden from meta_info, as hex strings.
+_META_FIELDS: Final[Tuple[str, ...]] = (
+    'base',
+    'mode',
+    'hdr_version',
+    'img_type',
+    'img_list_end',
+    'align_size',
+    'dsize_extend',
+    'maddr_extend',
+)
+
+# The file map payload starts with the marker, NUL-padded to this size,
+# followed by the "key=value" lines.
+_MAP_PREFIX: Final[bytes] = FILE_MAP_MARKER.ljust(504, b'\x00')
+
+_COMPRESSORS: Final[
+    Dict[CompressionFormat, Tuple[str, Callable[[Path], bytes]]]
+] = {
+    CompressionFormat.GZIP: ('gzip', compress_gz_file),
+    CompressionFormat.XZ: ('xz', compress_xz_file),
+}
+
+
+def _compression_result(
+    future: Future[bytes],
+    compress_file: Callable[[Path], bytes],
+    file_path: Path,
+) -> bytes:
+    """
+    Get the result of a compression job submitted to a worker process.
+
+    Args:
+        future: Future of the submitted job
+        compress_file: Compression function the job was running
+        file_path: Path of the file being compressed
+
+    Returns:
+        Compressed data (compressed in this process instead if the
+        worker pool could not be used)
+    """
+    try:
+        return future.result()
+    except BrokenExecutor:
+        return compress_file(file_path)
+
+
+def _map_file(file_path: Path, output_path: Path) -> Union[bytes, memoryview]:
+    """
+    Get the contents of a file to pack without copying them into memory.
+
+    Args:
+        file_path: Path to the file
+        output_path: Path the image will be written to
+
+    Returns:
+        Read-only view of the mapped file, or its contents as bytes if it
+        is empty or is the output image itself
+    """
+    with open(file_path, 'rb') as f:
+        # The output is truncated on save, which would pull a mapping of
+        # it out from under the image, so that one file is read instead.
+        if not os.fstat(f.fileno()).st_size or (
+            output_path.exists() and os.path.samefile(file_path, output_path)
+        ):
+            return f.read()
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return memoryview(mm)
+
 
 class Md1Packer:
     """
@@ -71,13 +148,23 @@ class Md1Packer:
 
         map_file_path = None
         meta_info_path = None
+        file_paths: List[Path] = []
+
+        # A single scandir pass; DirEntry.is_file() can usually answer from
+        # the directory listing itself without another stat call.
+        with os.scandir(directory_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+
+                path = directory_path / entry.name
+                if entry.name == 'meta_info':
+                    meta_info_path = path
+                    continue
 
-        for entry in directory_path.iterdir():
-            if entry.is_file():
                 if 'md1_file_map' in entry.name:
-                    map_file_path = entry
-                elif entry.name == 'meta_info':
-                    meta_info_path = entry
+                    map_file_path = path
+                file_paths.append(path)
 
         if map_file_path:
             try:
@@ -95,10 +182,7 @@ class Md1Packer:
             except (OSError, IOError) as e:
                 logger.warning(f'Failed to read meta_info: {e}')
 
-        for entry in directory_path.iterdir():
-            if entry.is_file() and entry.name != 'meta_info':
-                self.files.append(entry)
-
+        self.files.extend(file_paths)
         self.files.sort(key=lambda f: extract_number(f.name))
 
         logger.info(f'Added {len(self.files)} files from {directory}')
@@ -144,6 +228,19 @@ class Md1Packer:
         image.file_mapping = self.file_mapping
         base_address = 0
 
+        # Index the mapping once instead of scanning it for every file. A
+        # key matches a file named like it, with or without its .gz/.xz
+        # suffix; where several keys match, the first one wins, as before.
+        mapped_by_stem: Dict[str, str] = {}
+        key_by_mapped: Dict[str, str] = {}
+        for key, value in self.file_mapping.items():
+            key_lower = key.lower()
+            mapped_by_stem.setdefault(key_lower, value)
+            if key_lower.endswith(('.gz', '.xz')):
+                mapped_by_stem.setdefault(key_lower[:-3], value)
+            key_by_mapped.setdefault(value, key_lower)
+
+        jobs: List[Tuple[Path, str, Optional[CompressionFormat]]] = []
         for file_path in self.files:
             file_name = file_path.name
 
@@ -152,156 +249,150 @@ class Md1Packer:
 
             stripped_name = strip_number(file_name)
 
-            mapped_name = stripped_name
-            for key, value in self.file_mapping.items():
-                if to_lowercase(key) == to_lowercase(stripped_name):
-                    mapped_name = value
-                    break
-
-                if (
-                    to_lowercase(key) == to_lowercase(stripped_name) + '.gz'
-                    or to_lowercase(key) == to_lowercase(stripped_name) + '.xz'
-                ):
-                    mapped_name = value
-                    break
-
-            try:
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-            except (OSError, IOError) as e:
-                raise InvalidIOFile(f'Failed to read file: {e}', file_path)
+            mapped_name = mapped_by_stem.get(
+                stripped_name.lower(), stripped_name
+            )
 
             compress_to = None
-            for key, value in self.file_mapping.items():
-                if value == mapped_name:
-                    if key.lower().endswith('.gz'):
-                        compress_to = CompressionFormat.GZIP
-                    elif key.lower().endswith('.xz'):
-                        compress_to = CompressionFormat.XZ
-                    break
-
-            if compress_to == CompressionFormat.GZIP:
-                try:
-                    file_data = compress_gz(file_data)
-                    logger.info(f'Compressed {file_name} using gzip')
-                except Exception as e:
-                    logger.warning(
-                        f'Failed to compress {file_name} with gzip: {e}'
-                    )
-
-            elif compress_to == CompressionFormat.XZ:
-                try:
-                    file_data = compress_xz(file_data)
-                    logger.info(f'Compressed {file_name} using xz')
-                except Exception as e:
-                    logger.warning(
-                        f'Failed to compress {file_name} with xz: {e}'
-                    )
-
-            if mapped_name in self.meta_info:
-                meta = self.meta_info[mapped_name]
-
-                header = Md1Header.create(mapped_name, len(file_data))
-
-                if 'base' in meta:
-                    try:
-                        header.base = int(meta['base'], 16)
-                    except ValueError:
-                        pass
-
-                if 'mode' in meta:
-                    try:
-                        header.mode = int(meta['mode'], 16)
-                    except ValueError:
-                        pass
-
-                if 'hdr_version' in meta:
-                    try:
-                        header.hdr_version = int(meta['hdr_version'], 16)
-                    except ValueError:
-                        pass
+            key_lower = key_by_mapped.get(mapped_name, '')
+            if key_lower.endswith('.gz'):
+                compress_to = CompressionFormat.GZIP
+            elif key_lower.endswith('.xz'):
+                compress_to = CompressionFormat.XZ
+
+            jobs.append((file_path, mapped_name, compress_to))
+
+        # Compression is CPU bound and independent per file, so when more
+        # than one file needs it, it is spread over worker processes.
+        # Where those aren't available (say, no sem_open on Android), the
+        # files are compressed one after another in this process instead.
+        compressed_count = sum(1 for job in jobs if job[2] is not None)
+        compressors = _COMPRESSORS
+        if self.config.fast_gzip:
+            compressors = {
+                **_COMPRESSORS,
+                CompressionFormat.GZIP: (
+                    'gzip',
+                    functools.partial(compress_gz_file, fast=True),
+                ),
+            }
+        executor: Optional[ProcessPoolExecutor] = None
+        if compressed_count > 1:
+            try:
+                executor = ProcessPoolExecutor(
+                    max_workers=min(compressed_count, os.cpu_count() or 1)
+                )
+            except (NotImplementedError, OSError, ImportError) as e:
+                logger.debug(f'Compressing in-process, no worker pool: {e}')
 
-                if 'img_type' in meta:
+        # Views of mapped input files, released once the image is written.
+        mapped_views: List[memoryview] = []
+        try:
+            futures: List[Optional[Future[bytes]]] = [
+                executor.submit(compressors[compress_to][1], file_path)
+                if executor is not None and compress_to is not None
+                else None
+                for file_path, _, compress_to in jobs
+            ]
+
+            for (file_path, mapped_name, compress_to), future in zip(
+                jobs, futures
+            ):
+                file_name = file_path.name
+
+                # Compressed files are streamed straight from disk, so the
+                # whole uncompressed payload never has to sit in memory.
+                file_data: Optional[Union[bytes, memoryview]] = None
+
+                if compress_to is not None:
+                    method, compress_file = compressors[compress_to]
                     try:
-                        header.img_type = int(meta['img_type'], 16)
-                    except ValueError:
-                        pass
-
-                if 'img_list_end' in meta:
+                        file_data = (
+                            _compression_result(
+                                future, compress_file, file_path
+                            )
+                            if future is not None
+                            else compress_file(file_path)
+                        )
+                        logger.info(f'Compressed {file_name} using {method}')
+                    except (OSError, IOError) as e:
+                        raise InvalidIOFile(
+                            f'Failed to read file: {e}', file_path
+                        )
+                    except Exception as e:
+                        logger.warning(
+                            f'Failed to compress {file_name} with {method}: {e}'
+                        )
+
+                if file_data is None:
                     try:
-                        header.img_list_end = int(meta['img_list_end'], 16)
-                    except ValueError:
-                        pass
+                        file_data = _map_file(file_path, output_path)
+                        if isinstance(file_data, memoryview):
+                            mapped_views.append(file_data)
+                    except (OSError, IOError) as e:
+                        raise InvalidIOFile(
+                            f'Failed to read file: {e}', file_path
+                        )
+
+                if mapped_name in self.meta_info:
+                    meta = self.meta_info[mapped_name]
+
+                    header = Md1Header.create(mapped_name, len(file_data))
+
+                    for field in _META_FIELDS:
+                        field_value = meta.get(field)
+                        if field_value is None:
+                            continue
+                        try:
+                            setattr(header, field, int(field_value, 16))
+                        except ValueError:
+                            pass
+                else:
+                    header = Md1Header.create(
+                        mapped_name, len(file_data), base_address
+                    )
 
-                if 'align_size' in meta:
-                    try:
-                        header.align_size = int(meta['align_size'], 16)
-                    except ValueError:
-                        pass
+                image.add_file(mapped_name, file_data, header=header)
 
-                if 'dsize_extend' in meta:
-                    try:
-                        header.dsize_extend = int(meta['dsize_extend'], 16)
-                    except ValueError:
-                        pass
+                # Headers built by create() always put the data right after
+                # themselves, and blocks are padded to 16 bytes.
+                base_address += (_HDR_SIZE + len(file_data) + 15) & ~15
 
-                if 'maddr_extend' in meta:
-                    try:
-                        header.maddr_extend = int(meta['maddr_extend'], 16)
-                    except ValueError:
-                        pass
-            else:
-                header = Md1Header.create(
-                    mapped_name, len(file_data), base_address
+                logger.info(
+                    f'Packed {file_name} as {mapped_name} (size: {len(file_data)} bytes)'
                 )
 
-            md1_file = Md1File(
-                name=mapped_name, header=header, data=file_data, offset=0
-            )
-            image.files.append(md1_file)
-
-            file_size = header.data_offset + len(file_data)
-            if file_size % 16 != 0:
-                file_size += 16 - (file_size % 16)
-            base_address += file_size
-
-            logger.info(
-                f'Packed {file_name} as {mapped_name} (size: {len(file_data)} bytes)'
-            )
+            if self.file_mapping:
+                map_content = ''.join(
+                    f'{key}={value}\n'
+                    for key, value in self.file_mapping.items()
+                ).encode('utf-8')
 
-        if self.file_mapping:
-            map_content = ''
-            for key, value in self.file_mapping.items():
-                map_content += f'{key}={value}\n'
-
-            map_data = bytearray(504)
+                map_data = _MAP_PREFIX + map_content
+                map_header = Md1Header.create(
+                    'md1_file_map', len(map_data), base_address
+                )
+                image.add_file('md1_file_map', map_data, header=map_header)
 
-            for i, b in enumerate(bytes('md1_file_map', 'ascii')):
-                if i < len(map_data):
-                    map_data[i] = b
+                logger.info('Added file mapping to image')
 
-            map_data.extend(map_content.encode('utf-8'))
-            map_header = Md1Header.create(
-                'md1_file_map', len(map_data), base_address
-            )
-            map_file = Md1File(
-                name='md1_file_map',
-                header=map_header,
-                data=bytes(map_data),
-                offset=0,
-            )
-            image.files.append(map_file)
+            try:
+                image.save(output_path)
+                logger.info(f'Successfully saved MD1 image to {output_path}')
+                return output_path
+            except (OSError, IOError) as e:
+                raise InvalidIOFile(
+                    f'Failed to write output file: {e}', output_path
+                )
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-            logger.info('Added file mapping to image')
-
-        try:
-            image.save(output_path)
-            logger.info(f'Successfully saved MD1 image to {output_path}')
-            return output_path
-        except (OSError, IOError) as e:
-            raise InvalidIOFile(
-                f'Failed to write output file: {e}', output_path
-            )
+            for view in mapped_views:
+                mm = view.obj
+                view.release()
+                if isinstance(mm, mmap.mmap):
+                    mm.close()
 
     def find_compression_type(
         self, file_name: str
@@ -315,19 +406,20 @@ class Md1Packer:
         Returns:
             CompressionFormat or None if no compression needed
         """
-        stripped_name = strip_number(file_name)
-        stripped_lower = to_lowercase(stripped_name)
+        stripped_lower = strip_number(file_name).lower()
+        gz_name = stripped_lower + '.gz'
+        xz_name = stripped_lower + '.xz'
 
-        for key, value in self.file_mapping.items():
-            key_lower = to_lowercase(key)
+        for key in self.file_mapping:
+            key_lower = key.lower()
 
-            if stripped_lower == key_lower:
+            if key_lower == stripped_lower:
                 return None
 
-            if key_lower.endswith('.gz') and stripped_lower == key_lower[:-3]:
+            if key_lower == gz_name:
                 return CompressionFormat.GZIP
 
-            if key_lower.endswith('.xz') and stripped_lower == key_lower[:-3]:
+            if key_lower == xz_name:
                 return CompressionFormat.XZ
 
         return (
@@ -6,7 +6,9 @@ SPDX-License-Identifier: GPL-3.0-or-later
 from __future__ import annotations
 
 import ctypes
-from typing import Dict, Union
+import mmap
+import struct
+from typing import Dict, Final, Iterator, Tuple, Union
 
 from md1imgpy.exceptions import HeaderError
 
@@ -18,6 +20,25 @@ XZ_HEADER = 0xFD377A585A00
 
 FILE_MAP_MARKER = b'md1_file_map'
 
+_GZ_MAGIC = GZ_HEADER.to_bytes(2, 'big')
+_XZ_MAGIC = XZ_HEADER.to_bytes(6, 'big')
+
+_MAGIC_STRUCT: Final = struct.Struct('<I')
+
+# Fields shown as hex after magic1, data_size and name, in header order.
+_HEX_FIELDS: Final[Tuple[str, ...]] = (
+    'base',
+    'mode',
+    'magic2',
+    'data_offset',
+    'hdr_version',
+    'img_type',
+    'img_list_end',
+    'align_size',
+    'dsize_extend',
+    'maddr_extend',
+)
+
 
 class Md1Header(ctypes.Structure):
     """
@@ -43,7 +64,7 @@ class Md1Header(ctypes.Structure):
     ]
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> Md1Header:
+    def from_bytes(cls, data: Union[bytes, memoryview]) -> Md1Header:
         """
         Create a header from raw bytes.
 
@@ -56,15 +77,42 @@ class Md1Header(ctypes.Structure):
         Raises:
             HeaderError: If data is too small or invalid
         """
-        if len(data) < ctypes.sizeof(cls):
-            raise HeaderError(f'Header data too small: {len(data)} bytes')
+        return cls.unpack_from(data)
+
+    @classmethod
+    def unpack_from(
+        cls, buffer: Union[bytes, memoryview, mmap.mmap], offset: int = 0
+    ) -> Md1Header:
+        """
+        Create a header from a buffer, starting at the given offset.
+
+        Unlike from_bytes, this avoids slicing the header out of a larger
+        buffer (such as a mapped image) before parsing it.
+
+        Args:
+            buffer: Buffer containing the header
+            offset: Offset of the header within the buffer
 
-        header = cls.from_buffer_copy(data)
+        Returns:
+            Md1Header instance
 
-        if header.magic1 != MD1IMG_MAGIC1 or header.magic2 != MD1IMG_MAGIC2:
+        Raises:
+            HeaderError: If the buffer is too small or the header is invalid
+        """
+        available = len(buffer) - offset
+        if available < ctypes.sizeof(cls):
+            raise HeaderError(f'Header data too small: {available} bytes')
+
+        # Check the magics before copying the whole header, so that probing
+        # offsets which don't hold a header stays cheap.
+        if (
+            _MAGIC_STRUCT.unpack_from(buffer, offset)[0] != MD1IMG_MAGIC1
+            or _MAGIC_STRUCT.unpack_from(buffer, offset + _MAGIC2_OFFSET)[0]
+            != MD1IMG_MAGIC2
+        ):
             raise HeaderError('Invalid magic numbers in header')
 
-        return header
+        return cls.from_buffer_copy(buffer, offset)
 
     def to_bytes(self) -> bytes:
         """
@@ -75,6 +123,24 @@ class Md1Header(ctypes.Structure):
         """
         return bytes(self)
 
+    def pack_into(
+        self, buffer: Union[bytearray, memoryview, mmap.mmap], offset: int = 0
+    ) -> None:
+        """
+        Write the header into a writable buffer at the given offset.
+
+        Unlike to_bytes, this copies the header straight into the target
+        (such as an image being assembled) without an intermediate copy.
+
+        Args:
+            buffer: Writable buffer to write the header into
+            offset: Offset within the buffer to write the header at
+        """
+        # Copy it as plain bytes, since memoryview targets only accept
+        # a source of the same format.
+        raw = memoryview(self).cast('B')
+        buffer[offset : offset + len(raw)] = raw
+
     def to_dict(self) -> Dict[str, Union[int, str]]:
         """
         Convert header to dictionary.
@@ -82,21 +148,22 @@ class Md1Header(ctypes.Structure):
         Returns:
             Dictionary containing header fields
         """
-        return {
-            'magic1': f'0x{self.magic1:08x}',
-            'data_size': self.data_size,
-            'name': self.name.decode('utf-8', errors='ignore').rstrip('\x00'),
-            'base': f'0x{self.base:08x}',
-            'mode': f'0x{self.mode:08x}',
-            'magic2': f'0x{self.magic2:08x}',
-            'data_offset': f'0x{self.data_offset:08x}',
-            'hdr_version': f'0x{self.hdr_version:08x}',
-            'img_type': f'0x{self.img_type:08x}',
-            'img_list_end': f'0x{self.img_list_end:08x}',
-            'align_size': f'0x{self.align_size:08x}',
-            'dsize_extend': f'0x{self.dsize_extend:08x}',
-            'maddr_extend': f'0x{self.maddr_extend:08x}',
-        }
+        return dict(self.items())
+
+    def items(self) -> Iterator[Tuple[str, Union[int, str]]]:
+        """
+        Iterate over the header fields in display form.
+
+        Same pairs as to_dict, without building a dictionary for them.
+
+        Returns:
+            Iterator of (field name, value) pairs, in header order
+        """
+        yield 'magic1', f'0x{self.magic1:08x}'
+        yield 'data_size', self.data_size
+        yield 'name', self.name.decode('utf-8', errors='ignore').rstrip('\x00')
+        for field in _HEX_FIELDS:
+            yield field, f'0x{getattr(self, field):08x}'
 
     @classmethod
     def create(cls, name: str, data_size: int, base: int = 0) -> Md1Header:
@@ -111,28 +178,10 @@ class Md1Header(ctypes.Structure):
         Returns:
             New Md1Header instance
         """
-        header = cls()
-        header.magic1 = MD1IMG_MAGIC1
+        header = cls.from_buffer_copy(_HEADER_TEMPLATE)
         header.data_size = data_size
-
-        name_bytes = name.encode('utf-8')
-        if len(name_bytes) > 31:
-            name_bytes = name_bytes[:31]
-
-        header.name = name_bytes
+        header.name = name.encode('utf-8')[:31]
         header.base = base
-        header.mode = 0
-        header.magic2 = MD1IMG_MAGIC2
-        header.data_offset = ctypes.sizeof(cls)
-        header.hdr_version = 0
-        header.img_type = 0
-        header.img_list_end = 0
-        header.align_size = 0
-        header.dsize_extend = 0
-        header.maddr_extend = 0
-
-        for i in range(len(header.reserved)):
-            header.reserved[i] = 0xFF
 
         return header
 
@@ -143,14 +192,26 @@ class Md1Header(ctypes.Structure):
         Returns:
             Formatted string with header information
         """
-        info = self.to_dict()
-        result = []
-        for key, value in info.items():
-            result.append(f'{key.ljust(15)}: {value}')
-        return '\n'.join(result)
+        return '\n'.join(f'{key:<15}: {value}' for key, value in self.items())
 
 
-def is_gz_format(data: bytes) -> bool:
+_MAGIC2_OFFSET: Final[int] = Md1Header.magic2.offset
+
+# Defaults shared by every new header; create() copies this in one go and
+# only fills in the per-file fields.
+_HEADER_TEMPLATE: Final = Md1Header(
+    magic1=MD1IMG_MAGIC1,
+    magic2=MD1IMG_MAGIC2,
+    data_offset=ctypes.sizeof(Md1Header),
+)
+ctypes.memset(
+    ctypes.addressof(_HEADER_TEMPLATE) + Md1Header.reserved.offset,
+    0xFF,
+    ctypes.sizeof(_HEADER_TEMPLATE.reserved),
+)
+
+
+def is_gz_format(data: Union[bytes, memoryview]) -> bool:
     """
     Check if data has a gzip header.
 
@@ -160,13 +221,10 @@ def is_gz_format(data: bytes) -> bool:
     Returns:
         True if data has gzip header, False otherwise
     """
-    if len(data) < 2:
-        return False
-
-    return data[0] == 0x1F and data[1] == 0x8B
+    return data[:2] == _GZ_MAGIC
 
 
-def is_xz_format(data: bytes) -> bool:
+def is_xz_format(data: Union[bytes, memoryview]) -> bool:
     """
     Check if data has an XZ header.
 
@@ -176,14 +234,4 @@ def is_xz_format(data: bytes) -> bool:
     Returns:
         True if data has XZ header, False otherwise
     """
-    if len(data) < 6:
-        return False
-
-    return (
-        data[0] == 0xFD
-        and data[1] == 0x37
-        and data[2] == 0x7A
-        and data[3] == 0x58
-        and data[4] == 0x5A
-        and data[5] == 0x00
-    )
+    return data[:6] == _XZ_MAGIC
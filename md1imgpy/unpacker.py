@@ -6,20 +6,95 @@ SPDX-License-Identifier: GPL-3.0-or-later
 from __future__ import annotations
 
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Final,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from md1imgpy.config import Md1ImgConfig
 from md1imgpy.exceptions import InvalidIOFile
 from md1imgpy.image import Md1Image
-from md1imgpy.structures import is_gz_format, is_xz_format
+from md1imgpy.structures import GZ_HEADER, XZ_HEADER
 from md1imgpy.utils import (
-    decompress_gz,
-    decompress_xz,
+    decompress_gz_to_file,
+    decompress_xz_to_file,
+    write_file,
 )
 
 logger = logging.getLogger(__name__)
 
+# Buffer size for decompressed files, well above the 8 KiB default.
+_WRITE_BUF: Final[int] = 1 << 18
+
+_Decompressor = Callable[[Union[bytes, memoryview], BinaryIO], None]
+
+# Compressed payloads by their magic: (format name, suffix, decompressor).
+_DECOMPRESSORS: Final[Dict[bytes, Tuple[str, str, _Decompressor]]] = {
+    GZ_HEADER.to_bytes(2, 'big'): ('gzip', '.gz', decompress_gz_to_file),
+    XZ_HEADER.to_bytes(6, 'big'): ('xz', '.xz', decompress_xz_to_file),
+}
+
+
+def _detect_compression(
+    data: Union[bytes, memoryview],
+) -> Optional[Tuple[str, str, _Decompressor]]:
+    """
+    Tell the compression format of a payload from its magic.
+
+    Args:
+        data: Raw data of the file
+
+    Returns:
+        (format name, suffix, decompressor) tuple, or None if the data
+        isn't compressed
+    """
+    head = bytes(data[:6])
+    return _DECOMPRESSORS.get(head[:2]) or _DECOMPRESSORS.get(head)
+
+
+def _write_output(
+    output_path: Path,
+    data: Union[bytes, memoryview],
+    decompress_to: Optional[_Decompressor] = None,
+) -> None:
+    """
+    Write a file's data to disk, decompressing it on the way if requested.
+
+    Decompressed data is streamed into the file, so it never has to be
+    held in memory as a whole. If decompression fails, the partially
+    written file is removed again.
+
+    Args:
+        output_path: Path of the file to write
+        data: Raw data of the file
+        decompress_to: Optional function that decompresses into a file
+
+    Raises:
+        OSError: If the file cannot be written
+        Md1ImgError: If decompression fails
+    """
+    if decompress_to is None:
+        write_file(output_path, data)
+        return
+
+    with open(output_path, 'wb', buffering=_WRITE_BUF) as f:
+        try:
+            decompress_to(data, f)
+        except Exception:
+            f.close()
+            output_path.unlink()
+            raise
+
 
 class Md1Unpacker:
     """
@@ -76,32 +151,26 @@ class Md1Unpacker:
         file_counter = 1
 
         meta_info_path = output_dir / 'meta_info'
-        try:
-            with open(meta_info_path, 'w') as f:
-                for md1_file in self.image.files:
-                    if md1_file.name == 'md1_file_map':
-                        continue
-
-                    f.write(f'name={md1_file.name}\n')
-                    header_dict = md1_file.header.to_dict()
-                    for key, value in header_dict.items():
-                        if key != 'name':
-                            f.write(f'{key}={value}\n')
-                    f.write('\n')
+        map_path = output_dir / 'md1_file_map'
+        map_content = ''.join(
+            f'{key}={value}\n' for key, value in self.image.file_mapping.items()
+        )
 
-            extracted_files.append(meta_info_path)
-            logger.info(f'Created meta_info file: {meta_info_path}')
-        except (OSError, IOError) as e:
-            raise InvalidIOFile(
-                f'Failed to write meta_info: {e}', meta_info_path
-            )
+        actual_names = self._actual_names()
 
+        # The meta_info lines are gathered in the same pass that plans the
+        # extraction, rather than walking the files (and headers) twice.
+        lines = []
+        jobs = []
         for md1_file in self.image.files:
-            mapped_name = None
-            for actual_name, internal_name in self.image.file_mapping.items():
-                if internal_name == md1_file.name:
-                    mapped_name = actual_name
-                    break
+            if md1_file.name != 'md1_file_map':
+                lines.append(f'name={md1_file.name}\n')
+                for key, value in md1_file.header.items():
+                    if key != 'name':
+                        lines.append(f'{key}={value}\n')
+                lines.append('\n')
+
+            mapped_name = actual_names.get(md1_file.name)
 
             if mapped_name:
                 output_name = f'{file_counter}_{mapped_name}'
@@ -110,56 +179,82 @@ class Md1Unpacker:
 
             output_path = output_dir / output_name
 
-            try:
-                data = md1_file.data
-                need_decompress = False
+            data = md1_file.data
+            decompress_to: Optional[_Decompressor] = None
 
-                if is_gz_format(data):
-                    need_decompress = True
-                    decompressed_data = decompress_gz(data)
+            compression = _detect_compression(data)
+            if compression:
+                _, suffix, decompress_to = compression
 
-                    if not mapped_name and output_path.suffix.lower() == '.gz':
-                        output_path = output_path.with_suffix('')
+                if not mapped_name and output_path.suffix.lower() == suffix:
+                    output_path = output_path.with_suffix('')
 
-                elif is_xz_format(data):
-                    need_decompress = True
-                    decompressed_data = decompress_xz(data)
-                    logger.info(f'Decompressed {output_name} (xz)')
+            jobs.append((output_name, output_path, data, decompress_to))
+            file_counter += 1
 
-                    if not mapped_name and output_path.suffix.lower() == '.xz':
-                        output_path = output_path.with_suffix('')
+        # Mapped names may point into subdirectories; create each of them
+        # once up front rather than from every worker writing into them.
+        parents = {output_path.parent for _, output_path, _, _ in jobs}
+        parents.discard(output_dir)
+        for parent in parents:
+            try:
+                parent.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                raise InvalidIOFile(f'Failed to create directory: {e}', parent)
 
-                with open(output_path, 'wb') as f:
-                    if need_decompress:
-                        f.write(decompressed_data)
+        # meta_info is written before anything is extracted, so failing to
+        # write it leaves no half-extracted directory behind.
+        try:
+            meta_info_path.write_text(''.join(lines))
+            extracted_files.append(meta_info_path)
+            logger.info(f'Created meta_info file: {meta_info_path}')
+        except (OSError, IOError) as e:
+            raise InvalidIOFile(
+                f'Failed to write meta_info: {e}', meta_info_path
+            )
+
+        # Files are independent and zlib/lzma (and file writes) release the
+        # GIL, so they are extracted concurrently, together with the file
+        # map; results are still collected in order.
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(len(jobs) + 1, os.cpu_count() or 1))
+        ) as executor:
+            map_future = None
+            if self.image.file_mapping:
+                map_future = executor.submit(map_path.write_text, map_content)
+
+            futures = [
+                executor.submit(_write_output, output_path, data, decompress_to)
+                for _, output_path, data, decompress_to in jobs
+            ]
+
+            for (output_name, output_path, _, decompress_to), future in zip(
+                jobs, futures
+            ):
+                try:
+                    future.result()
+                    if decompress_to:
                         logging.info(
                             f'Decompressed {output_name} to {output_path}'
                         )
                     else:
-                        f.write(data)
                         logging.info(f'{output_name} written to {output_path}')
 
-                extracted_files.append(output_path)
+                    extracted_files.append(output_path)
 
-            except Exception as e:
-                logger.error(f'Failed to extract {output_name}: {e}')
+                except Exception as e:
+                    logger.error(f'Failed to extract {output_name}: {e}')
 
-            file_counter += 1
+            if map_future is not None:
+                try:
+                    map_future.result()
+                    extracted_files.append(map_path)
+                    logger.info(f'Created file mapping: {map_path}')
 
-        if self.image.file_mapping:
-            map_path = output_dir / 'md1_file_map'
-            try:
-                with open(map_path, 'w') as f:
-                    for key, value in self.image.file_mapping.items():
-                        f.write(f'{key}={value}\n')
-
-                extracted_files.append(map_path)
-                logger.info(f'Created file mapping: {map_path}')
-
-            except (OSError, IOError) as e:
-                raise InvalidIOFile(
-                    f'Failed to write file mapping: {e}', map_path
-                )
+                except (OSError, IOError) as e:
+                    raise InvalidIOFile(
+                        f'Failed to write file mapping: {e}', map_path
+                    )
 
         return extracted_files
 
@@ -189,6 +284,8 @@ class Md1Unpacker:
             return None
 
         if not output_path:
+            # Only one name is needed, so stop at the first match instead
+            # of building the whole reverse lookup.
             mapped_name = None
             for actual_name, internal_name in self.image.file_mapping.items():
                 if internal_name == file_name:
@@ -201,28 +298,21 @@ class Md1Unpacker:
 
         try:
             data = md1_file.data
-            need_decompress = False
+            decompress_to: Optional[_Decompressor] = None
 
             if decompress:
-                if is_gz_format(data):
-                    need_decompress = True
-                    data = decompress_gz(data)
-                    logger.info(f'Decompressed {file_name} (gzip)')
-
-                elif is_xz_format(data):
-                    need_decompress = True
-                    data = decompress_xz(data)
-                    logger.info(f'Decompressed {file_name} (xz)')
+                compression = _detect_compression(data)
+                if compression:
+                    decompress_to = compression[2]
 
             output_path.parent.mkdir(parents=True, exist_ok=True)
 
-            with open(output_path, 'wb') as f:
-                f.write(data)
+            _write_output(output_path, data, decompress_to)
 
-            if need_decompress:
-                print(f'Decompressed {file_name} to {output_path}')
+            if decompress_to:
+                logger.info(f'Decompressed {file_name} to {output_path}')
             else:
-                print(f'{file_name} written to {output_path}')
+                logger.info(f'{file_name} written to {output_path}')
 
             return output_path
 
@@ -239,19 +329,13 @@ class Md1Unpacker:
             List of dictionaries with file information
         """
         result = []
+        actual_names = self._actual_names()
 
         for i, md1_file in enumerate(self.image.files, 1):
-            mapped_name = None
-            for actual_name, internal_name in self.image.file_mapping.items():
-                if internal_name == md1_file.name:
-                    mapped_name = actual_name
-                    break
+            mapped_name = actual_names.get(md1_file.name)
 
-            compression = 'none'
-            if is_gz_format(md1_file.data):
-                compression = 'gzip'
-            elif is_xz_format(md1_file.data):
-                compression = 'xz'
+            detected = _detect_compression(md1_file.data)
+            compression = detected[0] if detected else 'none'
 
             file_info = {
                 'index': i,
@@ -266,3 +350,20 @@ class Md1Unpacker:
             result.append(file_info)
 
         return result
+
+    def _actual_names(self) -> Dict[str, str]:
+        """
+        Build a lookup from internal file names to their actual names.
+
+        The image's file mapping goes the other way round, so this avoids
+        scanning it once per file. It is rebuilt on every call since the
+        mapping may be replaced or edited between calls.
+
+        Returns:
+            Dictionary mapping internal names to actual names (the first
+            entry wins if several map to the same internal name)
+        """
+        actual_names: Dict[str, str] = {}
+        for actual_name, internal_name in self.image.file_mapping.items():
+            actual_names.setdefault(internal_name, actual_name)
+        return actual_names
@@ -5,13 +5,19 @@ SPDX-License-Identifier: GPL-3.0-or-later
 
 from __future__ import annotations
 
+import errno
+import functools
 import gzip
+import io
 import logging
+import os
 import re
 import shutil
+import subprocess
+import zlib
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Any, BinaryIO, Dict, Final, Optional, Union
 
 try:
     import lzma
@@ -20,10 +26,31 @@ try:
 except ImportError:
     LZMA_AVAILABLE = False
 
+try:
+    from isal import igzip, isal_zlib
+
+    ISAL_AVAILABLE = True
+except ImportError:
+    ISAL_AVAILABLE = False
+
 from md1imgpy.exceptions import InvalidIOFile, Md1ImgError
 
 logger = logging.getLogger(__name__)
 
+# Data is streamed through the (de)compressors in chunks of this size.
+_CHUNK_SIZE: Final[int] = 1024 * 1024
+
+_NUMBER_PREFIX_RE: Final = re.compile(r'^\d+')
+_NUMBERED_NAME_RE: Final = re.compile(r'^(\d+)_(.+)$')
+
+# Records in meta_info are separated by (possibly whitespace-only) blank lines.
+_BLANK_LINES_RE: Final = re.compile(r'\n\s*\n')
+
+# Errors from copy_file_range that just mean it can't be used for a copy.
+_COPY_FILE_RANGE_UNSUPPORTED: Final = frozenset(
+    (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM)
+)
+
 
 def create_backup(image_path: Path, backup_dir: Optional[Path] = None) -> Path:
     """
@@ -49,12 +76,110 @@ def create_backup(image_path: Path, backup_dir: Optional[Path] = None) -> Path:
         backup_path = image_path.parent / backup_name
 
     try:
-        shutil.copy2(image_path, backup_path)
+        if not _copy_file_range(image_path, backup_path):
+            shutil.copy2(image_path, backup_path)
         return backup_path
     except OSError as e:
         raise InvalidIOFile(str(e), backup_path)
 
 
+def _copy_file_range(source: Path, destination: Path) -> bool:
+    """
+    Copy a file (and its metadata, like shutil.copy2) with copy_file_range.
+
+    The data never leaves the kernel, and filesystems that support
+    reflinks (such as Btrfs or XFS) can share the blocks instead of
+    copying them at all.
+
+    Args:
+        source: File to copy
+        destination: Path of the copy
+
+    Returns:
+        True if the file was copied, False if copy_file_range isn't
+        available or supported here (nothing has been copied then)
+
+    Raises:
+        OSError: If the copy fails for any other reason
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return False
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        copied = 0
+        while True:
+            try:
+                count = os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30)
+            except OSError as e:
+                if copied or e.errno not in _COPY_FILE_RANGE_UNSUPPORTED:
+                    raise
+                return False
+
+            if not count:
+                break
+            copied += count
+
+    shutil.copystat(source, destination)
+    return True
+
+
+def preallocate_file(fd: int, size: int) -> None:
+    """
+    Size a file up front, reserving its disk space where supported.
+
+    Reserving the space means running out of it fails here rather than
+    later, while writing through a memory mapping of the file.
+
+    Args:
+        fd: File descriptor of the file, opened for writing
+        size: Size to give the file
+
+    Raises:
+        OSError: If the file cannot be resized
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            # Not every filesystem supports it; a plain resize still works.
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    os.ftruncate(fd, size)
+
+
+def write_file(path: Union[str, Path], data: Union[bytes, memoryview]) -> None:
+    """
+    Write data to a new file in one go, with its space reserved up front.
+
+    This skips the buffered file object layers, and reserving the space
+    first lets the filesystem lay the file out in as few extents as it can.
+
+    Args:
+        path: Path of the file to write (replaced if it exists)
+        data: Data to write
+
+    Raises:
+        OSError: If the file cannot be written
+    """
+    fd = os.open(
+        path,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+        0o666,
+    )
+    try:
+        view = memoryview(data)
+        if view.nbytes:
+            preallocate_file(fd, view.nbytes)
+
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
 def extract_number(filename: str) -> int:
     """
     Extract the numerical prefix from a filename.
@@ -65,7 +190,11 @@ def extract_number(filename: str) -> int:
     Returns:
         Extracted number, or 0 if no number found
     """
-    match = re.match(r'^\d+', filename)
+    # Most names carry no prefix, so skip the regex when they can't match.
+    if not filename[:1].isdigit():
+        return 0
+
+    match = _NUMBER_PREFIX_RE.match(filename)
     if match:
         return int(match.group(0))
     return 0
@@ -81,53 +210,63 @@ def strip_number(filename: str) -> str:
     Returns:
         Filename without numerical prefix
     """
-    match = re.match(r'^(\d+)_(.+)$', filename)
+    if not filename[:1].isdigit():
+        return filename
+
+    match = _NUMBERED_NAME_RE.match(filename)
     if match:
         return match.group(2)
     return filename
 
 
-def to_lowercase(text: str) -> str:
+def compress_gz(data: bytes, fast: bool = False) -> bytes:
     """
-    Convert text to lowercase.
+    Compress data using gzip.
 
     Args:
-        text: Text to convert
+        data: Data to compress
+        fast: Use ISA-L (if installed), which is much faster but
+            compresses less than zlib's best level
 
     Returns:
-        Lowercase text
-    """
-    return text.lower()
-
-
-def ends_with(text: str, suffix: str) -> bool:
+        Compressed data
     """
-    Check if text ends with a specific suffix.
-
-    Args:
-        text: Text to check
-        suffix: Suffix to check for
+    if fast and ISAL_AVAILABLE:
+        return igzip.compress(
+            data, compresslevel=isal_zlib.ISAL_BEST_COMPRESSION
+        )
 
-    Returns:
-        True if text ends with suffix, False otherwise
-    """
-    return text.endswith(suffix)
+    return gzip.compress(data, compresslevel=9)
 
 
-def compress_gz(data: bytes) -> bytes:
+def compress_gz_file(file_path: Union[str, Path], fast: bool = False) -> bytes:
     """
-    Compress data using gzip.
+    Compress a file using gzip without reading it into memory first.
 
     Args:
-        data: Data to compress
+        file_path: Path to the file to compress
+        fast: Use ISA-L (if installed), which is much faster but
+            compresses less than zlib's best level
 
     Returns:
         Compressed data
+
+    Raises:
+        OSError: If the file cannot be read
     """
-    return gzip.compress(data, compresslevel=9)
+    if fast and ISAL_AVAILABLE:
+        compressor = isal_zlib.compressobj(
+            isal_zlib.ISAL_BEST_COMPRESSION,
+            isal_zlib.DEFLATED,
+            16 + isal_zlib.MAX_WBITS,
+        )
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return _compress_file(file_path, compressor)
 
 
-def decompress_gz(data: bytes) -> bytes:
+def decompress_gz(data: Union[bytes, memoryview]) -> bytes:
     """
     Decompress gzipped data.
 
@@ -140,12 +279,71 @@ def decompress_gz(data: bytes) -> bytes:
     Raises:
         Md1ImgError: If decompression fails
     """
+    # Single-member payloads (the usual case) go straight through zlib;
+    # anything else (more members, padding, errors) is left to gzip.
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        result = decompressor.decompress(data)
+        if decompressor.eof and not decompressor.unused_data:
+            return result
+    except zlib.error:
+        pass
+
     try:
         return gzip.decompress(data)
     except gzip.BadGzipFile as e:
         raise Md1ImgError(f'Error decompressing gzip data: {e}')
 
 
+def decompress_gz_to_file(
+    data: Union[bytes, memoryview], output: BinaryIO
+) -> None:
+    """
+    Decompress gzipped data straight into a file, one chunk at a time.
+
+    Args:
+        data: Compressed data
+        output: File to write the decompressed data to
+
+    Raises:
+        Md1ImgError: If decompression fails
+    """
+    # The input is fed as slices of a view over it: unconsumed_tail is a
+    # copy, so handing over all of it would copy the rest of the payload
+    # again for every chunk of output.
+    view = memoryview(data)
+
+    try:
+        while True:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            position = 0
+            pending: Union[bytes, memoryview] = b''
+
+            while not decompressor.eof:
+                if not pending:
+                    pending = view[position : position + _CHUNK_SIZE]
+                    position += len(pending)
+
+                chunk = decompressor.decompress(pending, _CHUNK_SIZE)
+                pending = decompressor.unconsumed_tail
+                if not (
+                    chunk or pending or decompressor.eof or position < len(view)
+                ):
+                    raise Md1ImgError(
+                        'Error decompressing gzip data: unexpected end of stream'
+                    )
+                output.write(chunk)
+
+            # Like gzip.decompress, accept concatenated members and
+            # trailing zero padding.
+            rest = view[position - len(decompressor.unused_data) :]
+            view = memoryview(rest.tobytes().lstrip(b'\x00'))
+            if not view:
+                break
+    except zlib.error as e:
+        raise Md1ImgError(f'Error decompressing gzip data: {e}')
+
+
 def compress_xz(data: bytes) -> bytes:
     """
     Compress data using xz/lzma.
@@ -167,7 +365,63 @@ def compress_xz(data: bytes) -> bytes:
     return lzma.compress(data, preset=9)
 
 
-def decompress_xz(data: bytes) -> bytes:
+def compress_xz_file(file_path: Union[str, Path]) -> bytes:
+    """
+    Compress a file using xz/lzma without reading it into memory first.
+
+    Args:
+        file_path: Path to the file to compress
+
+    Returns:
+        Compressed data
+
+    Raises:
+        Md1ImgError: If LZMA compression is not available
+        OSError: If the file cannot be read
+    """
+    if not LZMA_AVAILABLE:
+        raise Md1ImgError(
+            'LZMA compression is not available. Install the lzma module.'
+        )
+
+    return _compress_file(file_path, lzma.LZMACompressor(preset=9))
+
+
+def _compress_file(file_path: Union[str, Path], compressor: Any) -> bytes:
+    """
+    Feed a file through a streaming compressor in fixed-size chunks.
+
+    Args:
+        file_path: Path to the file to compress
+        compressor: zlib or lzma compressor object
+
+    Returns:
+        Compressed data
+    """
+    output = bytearray()
+    chunk = bytearray(_CHUNK_SIZE)
+    view = memoryview(chunk)
+
+    with open(file_path, 'rb', buffering=0) as f:
+        # Ask for aggressive readahead, so that the kernel fetches the
+        # next chunks while the current one is being compressed.
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+
+        while True:
+            length = f.readinto(chunk)
+            if not length:
+                break
+            output += compressor.compress(view[:length])
+
+    output += compressor.flush()
+    return bytes(output)
+
+
+def decompress_xz(data: Union[bytes, memoryview]) -> bytes:
     """
     Decompress xz/lzma data.
 
@@ -191,6 +445,146 @@ def decompress_xz(data: bytes) -> bytes:
         raise Md1ImgError(f'Error decompressing LZMA data: {e}')
 
 
+def decompress_xz_to_file(
+    data: Union[bytes, memoryview], output: BinaryIO
+) -> None:
+    """
+    Decompress xz/lzma data straight into a file, one chunk at a time.
+
+    If the xz tool is installed and the output is a real file, the work is
+    handed to it instead: it can decode multi-block streams on several
+    threads and writes to the file directly. xz rejects some payloads the
+    in-process decoder accepts (such as trailing data after the stream),
+    so those are decoded again in-process, and both ways give the same
+    result.
+
+    Args:
+        data: Compressed data
+        output: File to write the decompressed data to
+
+    Raises:
+        Md1ImgError: If LZMA decompression is not available or fails
+    """
+    xz_path = _find_xz()
+    if xz_path is not None:
+        try:
+            output.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            pass
+        else:
+            start = output.tell()
+            try:
+                _run_xz(xz_path, data, output)
+                return
+            except Md1ImgError:
+                if not LZMA_AVAILABLE:
+                    raise
+
+            output.seek(start)
+            output.truncate()
+
+    if not LZMA_AVAILABLE:
+        raise Md1ImgError(
+            'LZMA decompression is not available. Install the lzma module.'
+        )
+
+    first_stream = True
+    while True:
+        decompressor = lzma.LZMADecompressor()
+        try:
+            chunk = decompressor.decompress(data, _CHUNK_SIZE)
+        except lzma.LZMAError as e:
+            # Like lzma.decompress, ignore trailing data after a stream.
+            if not first_stream:
+                break
+            raise Md1ImgError(f'Error decompressing LZMA data: {e}')
+
+        try:
+            while True:
+                output.write(chunk)
+                if decompressor.eof:
+                    break
+                if decompressor.needs_input:
+                    raise Md1ImgError(
+                        'Error decompressing LZMA data: unexpected end of stream'
+                    )
+                chunk = decompressor.decompress(b'', _CHUNK_SIZE)
+        except lzma.LZMAError as e:
+            raise Md1ImgError(f'Error decompressing LZMA data: {e}')
+
+        # Like xz, accept zero padding between and after streams.
+        data = decompressor.unused_data.lstrip(b'\x00')
+        if not data:
+            break
+        first_stream = False
+
+
+@functools.lru_cache(maxsize=None)
+def _find_xz() -> Optional[str]:
+    """
+    Look up the xz tool on PATH (once).
+
+    Returns:
+        Path to the xz executable, or None if it isn't installed
+    """
+    return shutil.which('xz')
+
+
+def _run_xz(
+    xz_path: str, data: Union[bytes, memoryview], output: BinaryIO
+) -> None:
+    """
+    Decompress xz data with the xz tool, writing into an open file.
+
+    Args:
+        xz_path: Path to the xz executable
+        data: Compressed data
+        output: File to write the decompressed data to
+
+    Raises:
+        Md1ImgError: If decompression fails
+    """
+    output.flush()
+
+    # xz writes straight into the output file, so the decompressed data
+    # never passes through this process. The input goes down a pipe in
+    # large blocking writes rather than through communicate(), which hands
+    # it over one pipe buffer at a time; xz only writes a short message to
+    # stderr on failure, so that can't fill up and stall it meanwhile.
+    try:
+        read_fd, write_fd = os.pipe()
+        try:
+            process = subprocess.Popen(
+                [xz_path, '--decompress', '--stdout', '--threads=0'],
+                stdin=read_fd,
+                stdout=output,
+                stderr=subprocess.PIPE,
+            )
+        except OSError:
+            os.close(write_fd)
+            raise
+        finally:
+            os.close(read_fd)
+
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(write_fd, view[:_CHUNK_SIZE]) :]
+        except BrokenPipeError:
+            # xz gave up early; its exit status and message tell why.
+            pass
+        finally:
+            os.close(write_fd)
+
+        _, stderr = process.communicate()
+    except OSError as e:
+        raise Md1ImgError(f'Error decompressing LZMA data: {e}')
+
+    if process.returncode != 0:
+        reason = stderr.decode('utf-8', errors='replace').strip()
+        raise Md1ImgError(f'Error decompressing LZMA data: {reason}')
+
+
 def parse_meta_info(meta_info_content: str) -> Dict[str, Dict[str, str]]:
     """
     Parse meta_info file content.
@@ -202,33 +596,17 @@ def parse_meta_info(meta_info_content: str) -> Dict[str, Dict[str, str]]:
         Dictionary of file metadata
     """
     result = {}
-    current_name = None
-    current_meta = {}
-
-    for line in meta_info_content.splitlines():
-        line = line.strip()
-        if not line:
-            if current_name:
-                result[current_name] = current_meta
-                current_name = None
-                current_meta = {}
-            continue
-
-        parts = line.split('=', 1)
-        if len(parts) != 2:
-            continue
-
-        key, value = parts
-        if key == 'name':
-            if current_name:
-                result[current_name] = current_meta
-                current_meta = {}
-            current_name = value
-        else:
-            current_meta[key] = value
 
-    if current_name:
-        result[current_name] = current_meta
+    for record in _BLANK_LINES_RE.split(meta_info_content):
+        meta = dict(
+            line.strip().split('=', 1)
+            for line in record.splitlines()
+            if '=' in line
+        )
+
+        name = meta.pop('name', None)
+        if name:
+            result[name] = meta
 
     return result
 
@@ -243,17 +621,8 @@ def read_file_mapping(mapping_content: str) -> Dict[str, str]:
     Returns:
         Dictionary mapping filenames to their actual paths
     """
-    mapping = {}
-    for line in mapping_content.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-
-        parts = line.split('=', 1)
-        if len(parts) != 2:
-            continue
-
-        value, key = parts
-        mapping[key] = value
-
-    return mapping
+    return dict(
+        line.strip().split('=', 1)[::-1]
+        for line in mapping_content.splitlines()
+        if '=' in line
+    )